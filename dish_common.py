@@ -31,7 +31,7 @@ HISTORY_STATS_MODES: List[str] = [
 UNGROUPED_MODES: List[str] = []
 
 
-def create_arg_parser(output_description, bulk_history=True):
+def create_arg_parser(output_description, bulk_history=True, loop_interval_help=None):
     """Create an argparse parser and add the common command line options."""
     parser = argparse.ArgumentParser(
         description="Collect status and/or history data from a Starlink user terminal and " +
@@ -58,8 +58,8 @@ def create_arg_parser(output_description, bulk_history=True):
                        "--loop-interval",
                        type=float,
                        default=float(LOOP_TIME_DEFAULT),
-                       help="Loop interval in seconds or 0 for no loop, default: " +
-                       str(LOOP_TIME_DEFAULT))
+                       help=(loop_interval_help or "Loop interval in seconds or 0 for no loop") +
+                       ", default: " + str(LOOP_TIME_DEFAULT))
     group.add_argument("-v", "--verbose", action="store_true", help="Be verbose")
 
     group = parser.add_argument_group(title="History mode options")
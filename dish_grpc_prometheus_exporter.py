@@ -1,38 +1,51 @@
 #!/usr/bin/python3
-"""Output Starlink user terminal data info in text format.
+"""Prometheus exporter for Starlink user terminal data info.
 
 This script pulls the current status info and/or metrics computed from the
-history data and prints them to a file or stdout either once or in a periodic
-loop. By default, it will print the results in CSV format.
+history data and makes it available via HTTP in the format Prometheus expects.
 
-Note that using this script to record the alert_detail group mode as CSV
-data is not recommended, because the number of alerts and their relative
-order in the output can change with the dish software. Instead of using
-the alert_detail mode, you can use the alerts bitmask in the status group.
+The dish is polled when Prometheus scrapes the exporter. The loop interval
+option sets the minimum time between polls; scrapes that arrive sooner are
+served the most recent sample.
+
+History stats cover the samples recorded since the previous poll. On the
+first poll, they cover the last loop interval's worth of seconds (or all
+available samples if the loop interval is 0) unless the samples option says
+otherwise. The poll loops option is not supported, since the exporter has no
+loop of its own to count.
 """
 
 import logging
+import queue
 import signal
+import socket
 import sys
+import threading
 import time
+from types import MappingProxyType
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple, Union, cast
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
 
 import dish_common
-import queue
 
-from prometheus_client import (CollectorRegistry, start_http_server)
-from prometheus_client.metrics_core import (GaugeMetricFamily, InfoMetricFamily)
+from prometheus_client import (CONTENT_TYPE_LATEST, generate_latest)
+from prometheus_client.metrics_core import (GaugeMetricFamily, InfoMetricFamily, Metric)
 
 log = logging.getLogger(__name__)
 
 DEFAULT_PORT = 9148
+HTTP_WORKERS = 4
 
 CONNECTION_STATES = ["UNKNOWN", "CONNECTED", "BOOTING", "SEARCHING",
                      "STOWED", "THERMAL_SHUTDOWN", "SLEEPING", "NO_SATS",
                      "OBSTRUCTED", "NO_DOWNLINK", "NO_PINGS", "DISH_UNREACHABLE"]
 
+# The dish status is exported as a single gauge holding the state's index
+STATE_IDX = MappingProxyType({s: i for i, s in enumerate(CONNECTION_STATES)})
+STATE_DOC = "Starlink Status " + "".join(f"{i} = {s}, " for i, s in enumerate(CONNECTION_STATES))
+
 
 STARLINK_NAME = "starlink"
-COUNTER_FIELD = "end_counter"
 VERBOSE_FIELD_MAP = {
     # status fields (the remainder are either self-explanatory or I don't
     # know with confidence what they mean)
@@ -71,19 +84,110 @@ VERBOSE_FIELD_MAP = {
 }
 
 
+class FieldSpec(NamedTuple):
+    metric_name: str
+    text: str
+
+
+# Precomputed spec per field, filled in on first use for fields not in
+# VERBOSE_FIELD_MAP.
+FIELD_SPECS: Dict[str, FieldSpec] = {k: FieldSpec(f"{STARLINK_NAME}_{k}", v) for k, v in VERBOSE_FIELD_MAP.items()}
+
+
+def field_spec(name: str) -> FieldSpec:
+    spec = FIELD_SPECS.get(name)
+    if spec is None:
+        spec = FIELD_SPECS[name] = FieldSpec(f"{STARLINK_NAME}_{name}", name)
+    return spec
+
+
 class Terminated(Exception):
     pass
 
 
+shutdown_event = threading.Event()
+
+
 def handle_sigterm(signum, frame):
     # Turn SIGTERM into an exception so main loop can clean up
+    shutdown_event.set()
     raise Terminated
 
 
+class QuietHandler(WSGIRequestHandler):
+    # Drop clients that connect and then go quiet, rather than leaving a
+    # worker thread blocked forever
+    timeout = 10
+
+    def handle(self):
+        try:
+            super().handle()
+        except socket.timeout:
+            log.debug("%s - request timed out", self.address_string())
+
+    def log_message(self, format, *args):
+        log.debug("%s - " + format, self.address_string(), *args)
+
+
+class MetricsServer(WSGIServer):
+    """WSGIServer that hands requests to a fixed pool of worker threads."""
+
+    def __init__(self, server_address, handler_class, address_family, workers):
+        # WSGIServer assumes IPv4, so the family is set before binding
+        self.address_family = address_family
+        super().__init__(server_address, handler_class)
+        # Daemon threads, so a client that is still connected does not hold
+        # up exit the way a ThreadPoolExecutor's joined workers would
+        self.pending = queue.Queue()
+        self.workers = workers
+        for _ in range(workers):
+            threading.Thread(target=self.process_requests, daemon=True).start()
+
+    def process_request(self, request, client_address):
+        self.pending.put((request, client_address))
+
+    def process_requests(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        for _ in range(self.workers):
+            self.pending.put(None)
+
+
+def start_metrics_server(port, addr, app):
+    """Serve a WSGI app over HTTP from a background thread.
+
+    Requests are handled by a pool of HTTP_WORKERS threads, so a slow client
+    or a scrape that is waiting on the dish does not hold up the others,
+    without starting a new thread for every request.
+    """
+    # Pick IPv4 or IPv6 to match the address
+    infos = socket.getaddrinfo(addr, port, type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE)
+    family, _, _, _, sockaddr = infos[0]
+    httpd = MetricsServer((sockaddr[0], port), QuietHandler, family, HTTP_WORKERS)
+    httpd.set_app(app)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+
 def parse_args():
 
-    parser = dish_common.create_arg_parser(output_description="Prometheus exporter",
-                                           bulk_history=False)
+    parser = dish_common.create_arg_parser(
+        output_description="Prometheus exporter",
+        bulk_history=False,
+        loop_interval_help="Minimum time in seconds between polls of the dish, or 0 to poll on "
+        "every scrape")
 
     group = parser.add_argument_group(title="Prometheus Exporter Options")
 
@@ -99,144 +203,215 @@ def parse_args():
                        help="Exporter Port : " + 
                        str(DEFAULT_PORT))
     
-    opts = dish_common.run_arg_parser(parser, modes=['status', 'obstruction_detail', 'alert_detail', 'location', 'ping_drop', 'usage'])
+    opts = dish_common.run_arg_parser(parser, modes=['status', 'obstruction_detail', 'alert_detail', 'location', 'ping_drop', 'ping_latency', 'usage'])
 
-    if (opts.history_stats_mode or opts.status_mode) and opts.bulk_mode and not opts.verbose:
-        parser.error("bulk_history cannot be combined with other modes for CSV output")
+    if opts.poll_loops > 1:
+        parser.error("Poll loops option is not supported by the exporter")
 
     return opts
 
+class MetricsSnapshot(object):
+    """The metric families for one sample, in the form generate_latest takes."""
+
+    def __init__(self, families: List[Metric]) -> None:
+        self.families = families
+
+    def collect(self) -> List[Metric]:
+        return self.families
+
+
 class StarlinkCollector(object):
 
-    def __init__(self):
+    def __init__(self, opts, gstate) -> None:
+        self.opts = opts
+        self.gstate = gstate
         self.last_dish_id = 'Unknown'
-        self.metrics_queue = queue.Queue()
-        pass
+        self._output = b""
+        self._fetch_lock = threading.Lock()
+        self._last_fetch: Optional[float] = None
+        self._names: List[str] = []
+        self._values: List[Union[float, str]] = []
+        self._specs: List[FieldSpec] = []
+        self._sequences: List[Tuple[FieldSpec, str, Sequence[Optional[float]], int]] = []
+        self._info: Optional[InfoMetricFamily] = None
+        self._info_key: Optional[Tuple[str, Dict[str, str]]] = None
         
-    def collect(self):
-        log.debug(f'collector called')
+    def wsgi_app(self, environ, start_response):
+        """Serve the exposition text rendered for the most recent sample.
+
+        The text is rendered once per sample by set_metrics, so a scrape that
+        does not need to poll the dish is just a copy of the cached bytes.
+        """
+        if environ.get("PATH_INFO", "").lower() == "/favicon.ico":
+            start_response("404 Not Found", [("Content-Type", "text/plain")])
+            return [b""]
         
-        metrics = self.set_metrics()
+        self.refresh()
+        output = self._output
+        if not output:
+            # The first poll failed, or we are shutting down before it ran
+            start_response("503 Service Unavailable", [("Content-Type", "text/plain")])
+            return [b""]
+        start_response("200 OK", [("Content-Type", CONTENT_TYPE_LATEST),
+                                  ("Content-Length", str(len(output)))])
+        return [output]
         
-        for metric in metrics.keys(): 
-            yield (metrics[metric])
+    def refresh(self) -> None:
+        """Poll the dish if the last sample is older than the loop interval.
+
+        Scrapes are handled on separate threads by MetricsServer, so more than
+        one can get here at once. If another scrape is already polling the
+        dish, return right away and let the caller serve the current sample
+        instead of waiting on the dish, unless there is no sample yet.
+        """
+        if shutdown_event.is_set() or not self._fetch_lock.acquire(blocking=not self._output):
+            return
+        try:
+            now = time.monotonic()
+            if self._last_fetch is None or now - self._last_fetch >= self.opts.loop_interval:
+                self._last_fetch = now
+                self.loop_body()
+        finally:
+            self._fetch_lock.release()
         
-    def set_metrics (self):
-    
-        return_metrics = {}
+    def shutdown(self) -> None:
+        """Wait for any poll still in progress, then close the dish connection.
+
+        shutdown_event must already be set, so no new poll can start.
+        """
+        with self._fetch_lock:
+            self.gstate.shutdown()
         
-        while not self.metrics_queue.empty():
-            metrics = self.metrics_queue.get()
-            
-            metrics_data = metrics['metrics_data']
-            time_metrics = metrics['time_metrics']
-            dish_id = metrics_data['id']['value']
-            info_metrics = {}
-
-            log.debug(f'id {dish_id}')
-                        
-            for metric in metrics_data.keys():
-                
-                if "snr" == metric:
-                    # snr is not supported by starlink any more but still returned by the grpc
-                    # service for backwards compatibility
-                    continue
+    def set_metrics(self, names: List[str], values: List[Union[float, str]],
+                    specs: List[FieldSpec],
+                    sequences: List[Tuple[FieldSpec, str, Sequence[Optional[float]], int]],
+                    dish_id: str, state: Optional[str], time_metrics: Optional[int]) -> None:
+        """Build the metric families for a new sample and publish them.
+
+        Called from loop_body with the data collected on that pass, so that
+        scrapes only ever see a complete set of families. The sample is passed
+        as parallel lists of field names, values and FieldSpecs, plus a list
+        of (FieldSpec, index label name, values, start index) for sequences.
+        """
+    
+        return_metrics: Dict[str, Metric] = {}
+        info_metrics: Dict[str, str] = {}
 
-                log.debug(f'metric {metric} metrics_data = {metrics_data[metric]}')
-                if type(metrics_data[metric]['value']) == str and  metric != 'id' and metric != 'state' :
-                    info_metrics[metric] = metrics_data[metric]['value']
-                    continue
+        log.debug('id %s', dish_id)
+        debug = log.isEnabledFor(logging.DEBUG)
                     
-                if type(metrics_data[metric]['value']) == float or type(metrics_data[metric]['value']) == int:
-                    if not metric in return_metrics:
-                        return_metrics[metric] = GaugeMetricFamily(name=f'{STARLINK_NAME}_{metric}',
-                                                        documentation=metrics_data[metric]['text'],
-                                                        labels=['id'])
-                    
-                    return_metrics[metric].add_metric(labels=[dish_id],
-                                        value=metrics_data[metric]['value'],
-                                        timestamp=time_metrics)
-        
-            if not 'info' in return_metrics:
-                return_metrics['info'] = InfoMetricFamily(f'{STARLINK_NAME}', 'Starlink Info', labels=['id'])
-            
-            return_metrics['info'].add_metric(labels=[dish_id], value=info_metrics, timestamp=time_metrics)
+        for metric, val, spec in zip(names, values, specs):
             
-            if 'state' in metrics_data:
-                self._add_status(return_metrics,dish_id, metrics_data['state']['value'] , time_metrics)
-                        
-        return(return_metrics)
-    
-    def _add_status(self,return_metrics, dish_id, starlink_status,time_metrics ):
-            starlink_states = { i:s for i, s in enumerate(CONNECTION_STATES) }
-            docu = ""
-            for key, val in starlink_states.items():
-                docu = docu + f"{key} = {val}, " 
-
-            if not 'state' in return_metrics:
-                return_metrics['state'] = GaugeMetricFamily(name=f'{STARLINK_NAME}_dish_status',
-                                                documentation="Starlink Status " + docu,
-                                                labels=['id'])
-                
-            for key,value in starlink_states.items():
-                if starlink_status == value:
-                    return_metrics['state'].add_metric(labels=[dish_id], value=key,
-                                                       timestamp=time_metrics)
-
-    def loop_body(self, opts, gstate, shutdown=False):
-        metrics_data = {}
+            if "snr" == metric:
+                # snr is not supported by starlink any more but still returned by the grpc
+                # service for backwards compatibility
+                continue
+
+            if debug:
+                log.debug('metric %s value = %s', metric, val)
+            # Values are either numbers or strings (_add_item drops None), so
+            # the common numeric case needs just the one type check.
+            if isinstance(val, (int, float)):
+                gauge = GaugeMetricFamily(name=spec.metric_name,
+                                          documentation=spec.text,
+                                          labels=['id'])
+                gauge.add_metric(labels=[dish_id], value=val, timestamp=time_metrics)
+                return_metrics[metric] = gauge
+            elif metric != 'id' and metric != 'state':
+                info_metrics[metric] = val
+        
+        # Each sequence is one family, with a sample per element. Missing
+        # elements are left out rather than exported as a misleading 0.
+        for spec, label, seq, start in sequences:
+            gauge = GaugeMetricFamily(name=spec.metric_name,
+                                      documentation=spec.text,
+                                      labels=['id', label])
+            for i, item in enumerate(seq, start):
+                if item is None:
+                    continue
+                gauge.add_metric(labels=[dish_id, str(i)], value=item, timestamp=time_metrics)
+            # A family with no samples would just be a bare HELP/TYPE block
+            if gauge.samples:
+                return_metrics[spec.metric_name] = gauge
     
-        log.debug(f'loop_body started')
+        # The info labels (hardware/software version, etc) rarely change, so
+        # only rebuild the family when they do. It carries no timestamp, since
+        # the same family may be served for many samples.
+        info_key = (dish_id, info_metrics)
+        info = self._info
+        if info is None or info_key != self._info_key:
+            info = InfoMetricFamily(f'{STARLINK_NAME}', 'Starlink Info', labels=['id'])
+            info.add_metric(labels=[dish_id], value=info_metrics)
+            self._info = info
+            self._info_key = info_key
+        return_metrics['info'] = info
+        
+        if state is not None:
+            self._add_status(return_metrics,dish_id, state, time_metrics)
     
-        def iform(val):
-            if val is None:
-                return 0
-            elif(val is True):
-                return 1
-            elif(val is False):
-                return 0
-            else:
-                return (val)
+        # Only the rendered text is kept between polls
+        self._output = generate_latest(MetricsSnapshot(list(return_metrics.values())))
     
-        def cb_data_add_item(name, val, category):
-            metrics_data[name] = {'value': iform(val),
-                        'text': VERBOSE_FIELD_MAP.get(name, name),
-                        'category': category }
-                
-        def cb_data_add_sequence(name, val, category, start):
-            pass
+    def _add_status(self, return_metrics: Dict[str, Metric], dish_id: str,
+                    starlink_status: str, time_metrics: Optional[int]) -> None:
+            # States this script does not know about are reported as UNKNOWN
+            status = GaugeMetricFamily(name=f'{STARLINK_NAME}_dish_status',
+                                       documentation=STATE_DOC,
+                                       labels=['id'])
+            status.add_metric(labels=[dish_id],
+                              value=STATE_IDX.get(starlink_status, 0),
+                              timestamp=time_metrics)
+            return_metrics['state'] = status
+
+    def _add_item(self, name: str, val: Union[float, str, None], category: str) -> None:
+        # Fields with no value (such as the ping latency stats when every
+        # ping was dropped) are left out rather than exported as 0. Booleans
+        # need no special case: numeric mode has already turned them into ints.
+        if val is None:
+            return
+        self._names.append(name)
+        self._values.append(val)
+        self._specs.append(field_spec(name))
+
+    def _add_sequence(self, name: str, val: Sequence[Optional[float]], category: str,
+                      start: int) -> None:
+        label = "decile" if name.startswith("deciles_") else "index"
+        self._sequences.append((field_spec(name), label, val, start))
+
+    def loop_body(self) -> int:
+        # set_metrics does not hold on to these, so they can be reused
+        names = self._names
+        values = self._values
+        specs = self._specs
+        sequences = self._sequences
+        names.clear()
+        values.clear()
+        specs.clear()
+        sequences.clear()
     
-        def cb_add_bulk(bulk, count, timestamp, counter):
-            pass
+        log.debug('loop_body started')
         
-        rc, status_ts, hist_ts = dish_common.get_data(opts,
-                                                      gstate,
-                                                      cb_data_add_item,
-                                                      cb_data_add_sequence,
-                                                      add_bulk=cb_add_bulk,
-                                                      flush_history=shutdown)
+        rc, status_ts, hist_ts = dish_common.get_data(self.opts,
+                                                      self.gstate,
+                                                      self._add_item,
+                                                      self._add_sequence)
         
-        log.debug(f'retun code: rc {rc} ')
+        log.debug('return code: rc %s', rc)
         if (status_ts is None or hist_ts is None):
-            log.debug(f'status_ts {status_ts} hist_ts {hist_ts}')
-        
+            log.debug('status_ts %s hist_ts %s', status_ts, hist_ts)
         
-        # log.debug(f'metrics_data {metrics_data}')
         
-        if rc == 0 and metrics_data and 'id' in metrics_data:
-            self.last_dish_id = metrics_data["id"]["value"]
-            log.debug (f'starlink_id = {metrics_data["id"]["value"]}')
-            self.metrics_queue.put({"metrics_data": metrics_data, "time_metrics": status_ts})
-        else:
-            metrics_data['state'] = {'value': 'NO_CONNECTION_WITH_DISH',
-                        'text': 'state',
-                        'category': 'status' }
-            
-            metrics_data['id'] = {'value': self.last_dish_id,
-                        'text': VERBOSE_FIELD_MAP.get(id, id),
-                        'category': 'status' }
-            time_metrics = int(time.time())
-            self.metrics_queue.put({"metrics_data": metrics_data, "time_metrics": time_metrics})
+        if 'id' in names:
+            self.last_dish_id = cast(str, values[names.index('id')])
+            log.debug('starlink_id = %s', self.last_dish_id)
+
+        # get_data reports DISH_UNREACHABLE itself when the status request
+        # fails, so only export a state when one was actually reported.
+        state = cast(str, values[names.index('state')]) if 'state' in names else None
+        time_metrics = status_ts or hist_ts or int(time.time())
+
+        self.set_metrics(names, values, specs, sequences, self.last_dish_id, state,
+                         time_metrics)
 
         return rc
     
@@ -256,34 +431,24 @@ def main():
         log.setLevel(level=logging.DEBUG)
         log.debug('debugging enabled')
     
-    rc = 0
-    
-    registry = CollectorRegistry()
-    
-    collector = StarlinkCollector()
-    registry.register(collector)
-
-    start_http_server(opts.exporter_port, addr='::', registry=registry)
+    collector = StarlinkCollector(opts, gstate)
 
+    httpd = start_metrics_server(opts.exporter_port, '::', collector.wsgi_app)
 
     try:
-        next_loop = time.monotonic()
-        while True:
-            log.debug('run loop_body')
-            rc = collector.loop_body(opts, gstate)
-            if opts.loop_interval > 0.0:
-                now = time.monotonic()
-                next_loop = max(next_loop + opts.loop_interval, now)
-                time.sleep(next_loop - now)
-            else:
-                break
+        # The dish is polled by the server threads, from wsgi_app when a
+        # scrape comes in, so all that is left to do here is wait to be told
+        # to stop.
+        shutdown_event.wait()
     except (KeyboardInterrupt, Terminated):
         pass
     finally:
-        collector.loop_body(opts, gstate, shutdown=True)
-        gstate.shutdown()    
+        shutdown_event.set()
+        httpd.shutdown()
+        httpd.server_close()
+        collector.shutdown()
     
-    sys.exit(rc)
+    sys.exit()
 
 
 if __name__ == "__main__":